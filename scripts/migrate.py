@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""rebuild vote tables created before `voted` got its server default"""
+
+import sqlite3
+import sys
+from pathlib import Path
+from typing import Any, List
+
+# schema as of this migration, main.py refuses to start on the old one so it cannot be imported here
+CREATE: List[str] = [
+    """CREATE TABLE vote (
+\tid INTEGER NOT NULL,
+\teditor VARCHAR(5) NOT NULL,
+\tvoted DATETIME DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')) NOT NULL,
+\tPRIMARY KEY (id),
+\tUNIQUE (id)
+)""",
+    "CREATE INDEX ix_vote_editor ON vote (editor)",
+    "CREATE INDEX ix_vote_voted ON vote (voted)",
+]
+
+INDEXES: List[str] = ["ix_vote_editor", "ix_vote_voted"]
+
+
+def main() -> int:
+    """entry/main function"""
+
+    database: Path = (
+        Path(sys.argv[1])
+        if len(sys.argv) > 1
+        else Path(__file__).resolve().parent.parent / "src" / "instance" / "voe.db"
+    )
+
+    if not database.exists():
+        print(f"{database} does not exist, nothing to migrate", file=sys.stderr)
+        return 0
+
+    # pysqlite autocommits ddl unless the transaction is managed by hand
+    connection: sqlite3.Connection = sqlite3.connect(database, isolation_level=None)
+
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+
+        columns: List[Any] = connection.execute("PRAGMA table_info(vote)").fetchall()
+        tables: List[Any] = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+
+        # an interrupted rebuild may have left only `old_vote` behind
+        if not columns and ("old_vote",) in tables:
+            connection.execute("ALTER TABLE old_vote RENAME TO vote")
+            tables.remove(("old_vote",))
+            columns = connection.execute("PRAGMA table_info(vote)").fetchall()
+
+        # sqlite cannot alter column defaults, so move the old table aside and recreate it
+        if columns and not any(column[1] == "voted" and column[4] is not None for column in columns):
+            if ("old_vote",) in tables:
+                print("both `vote` and `old_vote` exist, refusing to migrate", file=sys.stderr)
+                connection.execute("ROLLBACK")
+                return 1
+
+            connection.execute("ALTER TABLE vote RENAME TO old_vote")
+
+            for index in INDEXES:
+                connection.execute(f"DROP INDEX IF EXISTS {index}")
+
+            for statement in CREATE:
+                connection.execute(statement)
+
+            tables.append(("old_vote",))
+
+        # also recovers votes left behind by an interrupted rebuild
+        if ("old_vote",) in tables:
+            connection.execute("INSERT OR IGNORE INTO vote (id, editor, voted) SELECT id, editor, voted FROM old_vote")
+            connection.execute("DROP TABLE old_vote")
+
+        connection.execute("COMMIT")
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    assert main.__annotations__.get("return") is int, "main() should return an integer"
+    raise SystemExit(main())
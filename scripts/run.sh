@@ -6,6 +6,7 @@ main() {
     cd src
     kill -9 $(pgrep python3) || true
     python3 -m pip install gunicorn
+    python3 ../scripts/migrate.py || exit 1
     python3 -m gunicorn -b 127.0.0.1:8001 -w 1 main:app &
     disown
 }
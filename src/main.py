@@ -2,24 +2,27 @@
 # -*- coding: utf-8 -*-
 """vim-or-emacs.ari.lt"""
 
+import os
 import re
 import secrets
-from datetime import datetime
+import time
 from enum import Enum, auto
-from operator import itemgetter
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from warnings import filterwarnings as filter_warnings
 
 import flask
+import orjson
+from flask.json.provider import JSONProvider
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import DateTime
 from sqlalchemy import Enum as DBEnum
-from sqlalchemy import func
+from sqlalchemy import desc, event, func, insert, select, text
+from sqlalchemy.pool import QueuePool
 from werkzeug.exceptions import HTTPException
 from werkzeug.middleware.proxy_fix import ProxyFix
-from werkzeug.routing import Rule
 from werkzeug.wrappers import Response
 
 db: SQLAlchemy = SQLAlchemy()
@@ -37,9 +40,17 @@ class Editor(Enum):
         return tuple(cls)
 
 
+EDITORS_BY_VALUE: Dict[str, Editor] = {str(editor.value): editor for editor in Editor.all()}
+
+
 class Vote(db.Model):
     """vim or emacs vote"""
 
+    __table_args__ = (
+        db.Index("ix_vote_editor", "editor"),
+        db.Index("ix_vote_voted", "voted"),
+    )
+
     id: int = db.Column(
         db.Integer,
         primary_key=True,
@@ -52,7 +63,7 @@ class Vote(db.Model):
     )
     voted: DateTime = db.Column(
         DateTime,
-        default=datetime.utcnow,
+        server_default=text("(strftime('%Y-%m-%d %H:%M:%f', 'now'))"),
         nullable=False,
     )
 
@@ -61,26 +72,70 @@ class Vote(db.Model):
         self.editor = editor
 
 
+class ORJSONProvider(JSONProvider):
+    """orjson json provider"""
+
+    def dumps(self, obj: Any, **_: Any) -> str:
+        """serialize json"""
+        return orjson.dumps(
+            obj,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC,
+        ).decode()
+
+    def loads(self, s: str | bytes, **_: Any) -> Any:
+        """deserialize json"""
+        return orjson.loads(s)
+
+
 app: flask.Flask = flask.Flask(__name__)
+app.json = ORJSONProvider(app)
 
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)  # type: ignore
 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///voe.db"
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_pre_ping": True}
-app.config["SECRET_KEY"] = secrets.token_bytes(8**5)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "poolclass": QueuePool,
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_pre_ping": False,  # local sqlite connections do not drop
+    "connect_args": {"check_same_thread": False},
+}
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY") or secrets.token_bytes(64)
 app.config["PREFERRED_URL_SCHEME"] = "https"
 app.config["DOMAIN"] = "vim-or-emacs.ari.lt"
 
 db.init_app(app)
 
+
+def sqlite_pragmas(dbapi_connection: Any, _: Any) -> None:
+    """tune sqlite for concurrent reads"""
+
+    cursor: Any = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.close()
+
+
 with app.app_context():
+    event.listen(db.engine, "connect", sqlite_pragmas)
+
     db.create_all()
 
+    # create_all() leaves existing tables alone, and older ones have no default for `voted`
+    if not any(
+        column[1] == "voted" and column[4] is not None
+        for column in db.session.execute(text("PRAGMA table_info(vote)")).all()
+    ):
+        raise RuntimeError("the vote table predates the `voted` server default, run scripts/migrate.py first")
+
 limiter: Limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=["30 per minute", "6 per second"],
-    storage_uri="memory://",
+    storage_uri=os.environ.get("RATELIMIT_STORAGE_URI", "memory://"),
     strategy="fixed-window",
 )
 
@@ -96,14 +151,16 @@ def error_handler(e: HTTPException) -> Tuple[Any, int]:
     """handle http errors"""
 
     if e.code == 429:
-        return (
-            flask.Response(
-                f"too many requests : {e.description or '<limit>'}",
-                mimetype="text/plain",
-            ),
-            429,
+        response: flask.Response = flask.Response(
+            f"too many requests : {e.description or '<limit>'}",
+            mimetype="text/plain",
         )
 
+        if limiter.current_limit is not None:
+            response.headers["Retry-After"] = str(max(0, limiter.current_limit.reset_at - int(time.time())))
+
+        return response, 429
+
     return (
         flask.render_template(
             "http.j2",
@@ -131,31 +188,81 @@ def headers(response: flask.Response) -> flask.Response:
     return response
 
 
-@app.get("/")
-def index() -> str:
-    """index page"""
+CACHE_TTL: int = 5
+
+votes_epoch: int = 0
+
+
+def cache_key() -> Tuple[int, int]:
+    """key for cached vote aggregates, changes on new votes or after `CACHE_TTL` seconds"""
+    return votes_epoch, int(time.time()) // CACHE_TTL
+
+
+@lru_cache(maxsize=1)
+def winner(_: Tuple[int, int]) -> Tuple[Optional[Editor], int]:
+    """winning editor and its vote count, editor is `None` on a tie"""
 
     editor_counts: List[Tuple[Editor, int]] = (  # type: ignore
-        db.session.query(Vote.editor, func.count(Vote.editor))  # type: ignore
+        db.session.query(Vote.editor, func.count(Vote.editor).label("count"))  # type: ignore
         .group_by(Vote.editor)
+        .order_by(desc("count"))
+        .limit(2)
         .all()
     )
 
-    if len(editor_counts) == 0:  # type: ignore
+    top: Tuple[Optional[Editor], int] = None, -1
+    runner_up: int = -1
+
+    for editor, count in editor_counts:  # single pass top-2
+        if count > top[1]:
+            runner_up = top[1]
+            top = editor, count
+        elif count > runner_up:
+            runner_up = count
+
+    if top[0] is None:
         final_result: Tuple[Optional[Editor], int] = None, 0
-    elif len(editor_counts) == 1:  # type: ignore
-        final_result = editor_counts[0]  # type: ignore
+    elif top[1] > runner_up:
+        final_result = top  # we have a winner
     else:
-        sorted_counts: List[Tuple[Editor, int]] = sorted(editor_counts, key=itemgetter(1), reverse=True)[:2]  # type: ignore
+        final_result = None, top[1]  # its a tie
+
+    return final_result
+
+
+@lru_cache(maxsize=1)
+def stats(_: Tuple[int, int]) -> Dict[str, Any]:
+    """general vote statistics"""
+
+    total_votes, first_vote, latest_vote = db.session.query(  # type: ignore
+        func.count(Vote.id),  # type: ignore
+        func.min(Vote.voted),
+        func.max(Vote.voted),
+    ).one()
+
+    counts: Dict[Editor, int] = dict(
+        db.session.query(Vote.editor, func.count(Vote.id))  # type: ignore
+        .group_by(Vote.editor)
+        .all()
+    )
+
+    vote_counts: Dict[int, int] = {editor.value: counts.get(editor, 0) for editor in Editor.all()}
+
+    return {
+        "total": total_votes,
+        "votes": vote_counts,
+        "latest": latest_vote.timestamp() if latest_vote else None,  # type: ignore
+        "first": first_vote.timestamp() if first_vote else None,  # type: ignore
+    }
+
 
-        if sorted_counts[0][1] > sorted_counts[1][1]:
-            final_result = sorted_counts[0]  # we have a winner
-        else:
-            final_result = None, sorted_counts[0][1]  # its a tie
+@app.get("/")
+def index() -> str:
+    """index page"""
 
     return flask.render_template(
         "index.j2",
-        winner=final_result,
+        winner=winner(cache_key()),
     )
 
 
@@ -164,24 +271,23 @@ def index() -> str:
 def vote() -> Response:
     """vote"""
 
-    voe: Optional[str] = flask.request.form.get("voe")
+    global votes_epoch
 
-    if not voe:
-        flask.abort(400)
+    editor: Optional[Editor] = EDITORS_BY_VALUE.get(flask.request.form.get("voe", ""))
 
-    try:
-        editor: Editor = Editor(int(voe))
-    except Exception:
+    if editor is None:
         flask.abort(400)
 
     try:
-        vote: Vote = Vote(editor)
-
-        db.session.add(vote)
+        vote_id: int = db.session.execute(
+            insert(Vote).values(editor=editor).returning(Vote.id)  # type: ignore
+        ).scalar_one()
         db.session.commit()
 
+        votes_epoch += 1
+
         flask.flash(
-            f"Your vote for `{editor.name}` with ID `{vote.id}` has been recorded."
+            f"Your vote for `{editor.name}` with ID `{vote_id}` has been recorded."
         )
     except Exception:
         db.session.rollback()
@@ -196,10 +302,24 @@ def votes() -> str:
     return flask.render_template("votes.j2")
 
 
+EDITORS_JSON: bytes = orjson.dumps(
+    {editor.value: editor.name for editor in Editor.all()},
+    option=orjson.OPT_NON_STR_KEYS,
+)
+
+
 @app.get("/editors.json")
 def editors_json() -> Response:
     """editors"""
-    return flask.jsonify({editor.value: editor.name for editor in Editor.all()})
+    return flask.Response(EDITORS_JSON, mimetype="application/json")
+
+
+VOTES_LIMIT: int = 1000
+VOTES_MAX_LIMIT: int = 10000
+VOTES_CHUNK: int = 256
+
+SQLITE_INTEGER_MIN: int = -(2**63)
+SQLITE_INTEGER_MAX: int = 2**63 - 1
 
 
 @app.get("/votes.json")
@@ -208,7 +328,12 @@ def votes_json() -> Response:
 
     from_id: Optional[int] = flask.request.args.get("from", default=None, type=int)
     to_id: Optional[int] = flask.request.args.get("to", default=None, type=int)
-    editor: Optional[int] = flask.request.args.get("editor", default=None, type=int)
+    editor: Optional[str] = flask.request.args.get("editor", default=None)
+    limit: int = max(0, min(flask.request.args.get("limit", default=VOTES_LIMIT, type=int), VOTES_MAX_LIMIT))  # type: ignore
+
+    for bound in from_id, to_id:
+        if bound is not None and not SQLITE_INTEGER_MIN <= bound <= SQLITE_INTEGER_MAX:
+            flask.abort(400)
 
     filters: List[Any] = []
 
@@ -218,74 +343,83 @@ def votes_json() -> Response:
     if to_id is not None:
         filters.append(Vote.id <= to_id)
 
-    if editor is not None:
-        try:
-            filters.append(Vote.editor == Editor(editor))
-        except Exception:
-            pass
+    if editor in EDITORS_BY_VALUE:
+        filters.append(Vote.editor == EDITORS_BY_VALUE[editor])
 
-    votes: Dict[int, Dict[str, Any]] = {}
+    # execute before streaming so query errors still go through `error_handler`
+    rows: Any = db.session.execute(
+        select(Vote.id, Vote.editor, Vote.voted)  # type: ignore
+        .filter(*filters)
+        .order_by(Vote.id)
+        .limit(limit)
+        .execution_options(yield_per=VOTES_CHUNK)
+    )
+
+    def generate() -> Iterator[bytes]:
+        """stream votes as a json object, `VOTES_CHUNK` votes at a time"""
 
-    for vote in Vote.query.filter(*filters).all():  # type: ignore
-        votes[vote.id] = {  # type: ignore
-            "editor": vote.editor.value,  # type: ignore
-            "voted": vote.voted.timestamp(),  # type: ignore
-        }
+        chunk: List[bytes] = []
+        sep: bytes = b"{"
 
-    return flask.jsonify(votes)
+        for vote_id, vote_editor, voted in rows:
+            chunk.append(
+                b'%s"%d":%s'
+                % (
+                    sep,
+                    vote_id,
+                    orjson.dumps({"editor": vote_editor.value, "voted": voted.timestamp()}),
+                )
+            )
+            sep = b","
+
+            if len(chunk) >= VOTES_CHUNK:
+                yield b"".join(chunk)
+                chunk.clear()
+
+        chunk.append(b"{}" if sep == b"{" else b"}")
+        yield b"".join(chunk)
+
+    return flask.Response(
+        flask.stream_with_context(generate()),
+        mimetype="application/json",
+    )
 
 
 @app.get("/stats.json")
 def stats_json() -> Response:
     """stats"""
+    return flask.jsonify(stats(cache_key()))
 
-    votes: List[Vote] = Vote.query.all()  # type: ignore
-
-    total_votes: int = len(votes)  # type: ignore
-    vote_counts: Dict[int, int] = {editor.value: 0 for editor in Editor.all()}  # type: ignore
-    latest_vote: Optional[datetime] = max(votes, key=lambda vote: vote.voted).voted if votes else None  # type: ignore
-    first_vote: Optional[datetime] = min(votes, key=lambda vote: vote.voted).voted if votes else None  # type: ignore
-
-    for vote in votes:
-        vote_counts[vote.editor.value] += 1
 
-    return flask.jsonify(
-        {
-            "total": total_votes,
-            "votes": vote_counts,
-            "latest": latest_vote.timestamp() if latest_vote else None,  # type: ignore
-            "first": first_vote.timestamp() if first_vote else None,  # type: ignore
-        }
-    )
+ROBOTS_TXT: bytes = b"""User-agent: *
+Allow: *
+Sitemap: https://vim-or-emacs.ari.lt/sitemap.xml"""
+
+MANIFEST_JSON: bytes = orjson.dumps(
+    {
+        "$schema": "https://json.schemastore.org/web-manifest-combined.json",
+        "short_name": "Vim or Emacs",
+        "name": "Ari::web -> VimOrEmacs",
+        "description": "Vim or GNU Emacs?",
+        "icons": [{"src": "/favicon.ico", "sizes": "128x128", "type": "image/png"}],
+        "start_url": ".",
+        "display": "standalone",
+        "theme_color": "#fbfbfb",
+        "background_color": "#181818",
+    }
+)
 
 
 @app.route("/robots.txt", methods=["GET", "POST"])
 def robots_txt() -> flask.Response:
     """robots.txt file"""
-    return flask.Response(
-        """User-agent: *
-Allow: *
-Sitemap: https://vim-or-emacs.ari.lt/sitemap.xml""",
-        mimetype="text/plain",
-    )
+    return flask.Response(ROBOTS_TXT, mimetype="text/plain")
 
 
 @app.route("/manifest.json", methods=["GET", "POST"])
 def manifest_json() -> flask.Response:
     """manifest"""
-    return flask.jsonify(
-        {
-            "$schema": "https://json.schemastore.org/web-manifest-combined.json",
-            "short_name": "Vim or Emacs",
-            "name": "Ari::web -> VimOrEmacs",
-            "description": "Vim or GNU Emacs?",
-            "icons": [{"src": "/favicon.ico", "sizes": "128x128", "type": "image/png"}],
-            "start_url": ".",
-            "display": "standalone",
-            "theme_color": "#fbfbfb",
-            "background_color": "#181818",
-        }
-    )
+    return flask.Response(MANIFEST_JSON, mimetype="application/json")
 
 
 @app.route("/favicon.ico", methods=["GET", "POST"])
@@ -305,36 +439,30 @@ def git(_: str) -> Response:
     )
 
 
-rule: Rule
-
 pat: re.Pattern[str] = re.compile(r"<.+?:(.+?)>")
 
-sitemap: str = '<?xml version="1.0" encoding="UTF-8"?>\
-<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+URLS: Tuple[str, ...] = tuple(pat.sub(r"\1", rule.rule) for rule in app.url_map.iter_rules())
 
 
 def surl(loc: str) -> str:
     """sitemap url"""
+    return f'<url><loc>{app.config["PREFERRED_URL_SCHEME"]}://{app.config["DOMAIN"]}{loc}</loc><priority>1.0</priority></url>'
 
-    u: str = "<url>"
-    u += (
-        f'<loc>{app.config["PREFERRED_URL_SCHEME"]}://{app.config["DOMAIN"]}{loc}</loc>'
-    )
-    u += "<priority>1.0</priority>"
-    return u + "</url>"
 
+sitemap: str = (
+    '<?xml version="1.0" encoding="UTF-8"?>\
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+    + "".join(surl(url) for url in URLS)
+    + "</urlset>"
+)
 
-for rule in app.url_map.iter_rules():
-    url: str = pat.sub(r"\1", rule.rule)
-    sitemap += surl(url)
+SITEMAP_XML: bytes = sitemap.encode("utf-8")
 
 
 @app.route("/sitemap.xml", methods=["GET", "POST"])
 def sitemap_xml() -> flask.Response:
     """sitemap"""
-
-    esitemap: str = sitemap
-    return flask.Response(esitemap + "</urlset>", mimetype="application/xml")
+    return flask.Response(SITEMAP_XML, mimetype="application/xml")
 
 
 def main() -> int: